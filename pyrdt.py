@@ -1,12 +1,32 @@
 # http://www.iz2uuf.net/wp/index.php/2016/06/04/tytera-dm380-codeplug-binary-format/
 
 import argparse
+import re
+import json
+import sys
+import asyncio
+import array
 import struct
+import hashlib
+import os
+import time
+import threading
+import tempfile
+import shutil
+import heapq
+import itertools
+import random
+import concurrent.futures
+from multiprocessing import shared_memory, resource_tracker
 import math
 import csv
 import copy
+import copyreg
+import pickle
 import pdb
 import pprint
+import collections
+from collections import namedtuple
 from collections.abc import MutableMapping
 
 DEBUG = False
@@ -26,8 +46,8 @@ def bcd_decode(barray):
 def bcd_encode(dec_value, num_octets):
     """BCD encode (little endian) an integer"""
     # Check that we have sufficent encoding space
-    if math.log10(dec_value) >= (num_octets * 2):
-        return ValueError("{} cannot be BCD encoded in {} octets".format(dec_value, num_octets))
+    if dec_value >= 10 ** (num_octets * 2):
+        raise ValueError("{} cannot be BCD encoded in {} octets".format(dec_value, num_octets))
     encoded = bytearray()
     for i in range(num_octets):
         low_nybble = dec_value % 10
@@ -38,6 +58,35 @@ def bcd_encode(dec_value, num_octets):
         encoded.append(octet)
     return encoded
 
+def patch_bytes(buf, offset, mask, bits):
+    """Overwrite the bits selected by mask in buf[offset:], leaving the others alone"""
+    for n in range(len(mask)):
+        buf[offset + n] = (buf[offset + n] & ~mask[n]) | (bits[n] & mask[n])
+
+def atomic_write(fn, data):
+    """Write data to fn via a temporary file and rename, so fn is never half written
+
+    If fn is a symlink, its target is replaced. The file keeps its mode; a
+    new file gets the usual 0666 less the umask (mkstemp would make it 0600).
+    """
+    fn = os.path.realpath(fn)
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".pyrdt-")
+    try:
+        with os.fdopen(fd, "wb") as fo:
+            try:
+                shutil.copymode(fn, tmp_fn)
+            except FileNotFoundError:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.fchmod(fo.fileno(), 0o666 & ~umask)
+            fo.write(data)
+            fo.flush()
+            os.fsync(fo.fileno())
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        os.unlink(tmp_fn)
+        raise
+
 class Field():
     def __init__(self, **kwargs):
 
@@ -125,6 +174,42 @@ class Field():
 
         return "<<end of __repr__>>"
     
+    def typed_value(self):
+        """The value as a plain Python type (e.g. for JSON), None if unset
+
+        Strings are decoded, int/binary and BCD fields become ints (LUT keys,
+        not labels), and BCDT tones become {"system": "CTCSS"|"DCS-N"|"DCS-I", "code": ...}.
+        """
+        if self.type == "bitfield":
+            return None
+        if self.zero_valued():
+            try:
+                if self.value not in self.lut: return None
+            except AttributeError:
+                return None
+
+        if self.type == "ascii":
+            return self._value.decode('ascii', errors='replace').rstrip('\x00')
+        elif self.type == "unicode" or self.type == "utf16":
+            return self._value.decode('utf-16-le', errors='replace').rstrip('\x00')
+        elif self.type == "int" or self.type == "binary":
+            if type(self._value) is bytes:
+                return int.from_bytes(self._value, "little")
+            return self._value
+        elif self.type == "bcd":
+            return bcd_decode(self._value)
+        elif self.type == "rev_bcd":
+            return bcd_decode( reversed(self._value) )
+        elif self.type == "bcdt":
+            value_copy = bytearray(self._value)
+            value_copy[1] &= 0b00111111
+            tone = bcd_decode(value_copy)
+            squelch_type_id = ( self._value[1] & 0b11000000 ) >> 6
+            if squelch_type_id == 0:
+                return {"system": "CTCSS", "code": tone / 10.0}
+            return {"system": {1: "DCS-N", 2: "DCS-I"}.get(squelch_type_id, "unknown"), "code": tone}
+        return None
+
     @property
     def value(self):
         return self._value # TODO return __repr__ ?
@@ -145,6 +230,88 @@ class Field():
             return possibly_zeroed
         else:
             return False
+    @property
+    def byte_offset(self):
+        """Offset of the first octet holding this field, relative to the record"""
+        return self.offset // 8
+
+    def encode(self, value=None):
+        """Encode a raw value (default: the current one) as a record patch
+
+        Returns (byte_offset, mask, bits): the field occupies the octets at
+        byte_offset selected by mask, and bits holds the value in position.
+        Raw values are as found after load: int for fields of up to 8 bits,
+        bytes for wider fields (an int is accepted and stored little endian).
+        """
+        if value is None: value = self._value
+        if self.bits < 8:
+            # Same MSB-first bit numbering as Table._expand_bitfields
+            shift = 8 - (self.offset % 8) - self.bits
+            bitmask = (2 ** self.bits) - 1
+            if value > bitmask: raise ValueError("{} : {} does not fit in {} bits".format(self.id, value, self.bits))
+            return self.byte_offset, bytes([bitmask << shift]), bytes([value << shift])
+        if type(value) is int:
+            value = value.to_bytes(self.bits // 8, "little")
+        if len(value) != self.bits // 8:
+            raise ValueError("{} : {} octets given, field is {} octets".format(self.id, len(value), self.bits // 8))
+        return self.byte_offset, b'\xff' * len(value), bytes(value)
+
+    def parse(self, text):
+        """Convert a human-readable value to a raw value, as it would be after load
+
+        Accepts LUT labels ("high"), "unset" for the zero value, numbers for
+        int/binary fields, MHz ("446.00625") or raw digits for BCD, tones
+        ("88.5", "CTCSS 88.5", "D023N", "DCS D023I") for BCDT, and plain
+        text for string fields.
+        """
+        text = text.strip()
+        try:    # Lookup table
+            for k, label in self.lut.items():
+                if text.lower() == str(label).lower():
+                    return k
+        except AttributeError:
+            pass
+
+        octets = self.bits // 8
+        if text.lower() in ("unset", "disabled", "unset/disabled") and self.bits >= 8:
+            return self.zero_value if self.bits == 8 else bytes([self.zero_value]) * octets
+
+        if self.type == "ascii" or self.type == "unicode" or self.type == "utf16":
+            raw = text.encode('ascii' if self.type == "ascii" else 'utf-16-le')
+            if len(raw) > octets:
+                raise ValueError("{} : '{}' longer than {} octets".format(self.id, text, octets))
+            return raw.ljust(octets, b'\x00')
+        elif self.type == "int" or self.type == "binary":
+            value = int(text, 0)
+            if value < 0 or value >= 2 ** self.bits:
+                raise ValueError("{} : {} does not fit in {} bits".format(self.id, value, self.bits))
+            if getattr(self, 'min', '') and value < int(self.min):
+                raise ValueError("{} : {} less than defined minimum {}".format(self.id, value, self.min))
+            if getattr(self, 'max', '') and value > int(self.max):
+                raise ValueError("{} : {} greater than defined maximum {}".format(self.id, value, self.max))
+            return value if self.bits <= 8 else value.to_bytes(octets, "little")
+        elif self.type == "bcd":
+            if '.' in text:     # MHz; frequencies are stored in units of 10 Hz
+                return bytes( bcd_encode(round(float(text) * 100000), octets) )
+            return bytes( bcd_encode(int(text), octets) )
+        elif self.type == "rev_bcd":
+            return bytes( reversed(bcd_encode(int(text), octets)) )
+        elif self.type == "bcdt":
+            tone = text.upper().replace("CTCSS", "").replace("DCS", "").strip()
+            if tone.startswith("D") and tone[-1] in "NI":
+                squelch_type_id = 1 if tone[-1] == "N" else 2
+                tone = int(tone[1:-1])
+            else:
+                squelch_type_id = 0
+                tone = round(float(tone) * 10)
+            encoded = bcd_encode(tone, octets)
+            if encoded[1] & 0b11000000:
+                raise ValueError("{} : tone {} out of range".format(self.id, text))
+            encoded[1] |= squelch_type_id << 6
+            return bytes(encoded)
+        else:
+            raise ValueError("{} : cannot parse values of type {}".format(self.id, self.type))
+
     def add_constraint(self):
         pass
     
@@ -189,6 +356,9 @@ class Field():
             
             return True
     
+# Serializes the building of lazy Rows' Fields (see Row.from_columns)
+_row_build_lock = threading.Lock()
+
 class Row(MutableMapping):
     """Class Row encapsulates a set of fields, indexable by id,
     Providing additional metadata including display order, deletion marker
@@ -199,12 +369,74 @@ class Row(MutableMapping):
 
     def __init__(self, fields: dict, ordered_field_list: list = []):
         self._deleted = True                # Change to False once loaded 'n checked
-        self._storage = copy.deepcopy(fields)
+        # Each row needs its own Field objects to hold values, but the LUTs and
+        # constituent lists they point to are shared, read-only metadata.
+        # A shallow copy per Field is ~20x cheaper than deepcopy'ing the whole set.
+        self._storage = {k: copy.copy(v) for k,v in fields.items()}
 
         if ordered_field_list:
             self._ordered_field_list = ordered_field_list
         else:
             self._ordered_field_list = list( self._storage.keys() )
+    @classmethod
+    def from_columns(cls, fields, columns, n, deleted):
+        """Row for record n of Table.decode_columns() output
+
+        Its Field objects are only built, from the column buffers, when the
+        Row is first read or changed; until then it costs one small object.
+        """
+        row = cls.__new__(cls)
+        row._deleted = deleted
+        row._source = (fields, columns, n)
+        return row
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, i.e. on a Row from from_columns()
+        # whose Fields have not been built yet
+        if name in ('_storage', '_ordered_field_list'):
+            with _row_build_lock:
+                if '_source' in self.__dict__:  # not built by another thread meanwhile
+                    self._build_fields()
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _build_fields(self):
+        # Both attributes are published together, and only then is _source
+        # dropped, so other threads never see a half-built Row
+        fields, columns, n = self._source
+        storage = {}
+        for k, field in fields.items():
+            if field.type == "bitfield":
+                continue
+            # Same shallow copy as copy.copy(), without its per-call overhead
+            copied = storage[k] = Field.__new__(type(field))
+            copied.__dict__.update(field.__dict__)
+            field = copied
+            if k not in columns:
+                continue
+            column = columns[k]
+            if type(column) is bytes:
+                width = field.bits // 8
+                field.value = column[n * width:(n+1) * width]
+            else:
+                field.value = column[n]
+            field.validate()
+        self.__dict__.update( _storage=storage, _ordered_field_list=list(storage.keys()) )
+        del self.__dict__['_source']
+
+    def _raw_value(self, key):
+        """Raw value of field key, without building the Row's Fields"""
+        source = self.__dict__.get('_source')
+        if source is None:
+            return self._storage[key]._value
+        fields, columns, n = source
+        column = columns[key]
+        if type(column) is bytes:
+            width = fields[key].bits // 8
+            return column[n * width:(n+1) * width]
+        return column[n]
+
     def __getitem__(self, key):
         if key == "deleted":
             return self._deleted
@@ -227,19 +459,20 @@ class Row(MutableMapping):
     def __iter__(self):
         # overloadd to iterate in specific order
         #return iter(self._storage)
-        self._iter_list = copy.copy(self._ordered_field_list)
-        return self
-    def __next__(self):
-        if len(self._iter_list) > 0:
-            key = self._iter_list.pop(0)    # pop the head of the list
-            return key
-        raise StopIteration
+        # Iterate over a snapshot, so that keys may be deleted during iteration,
+        # and so that nested or concurrent iterations each get their own iterator
+        return iter( list(self._ordered_field_list) )
     def __len__(self):
         return len(self._storage)
 
+# (tabledef_fn, zero_value) => (field_names, field_struct_string, fields) from Table._read_fields
+_compiled_layouts = {}
+
 class Table():
     num_records = 1         # Must override except for general_settings
     zero_value  = 0xFF      # Overrride if diff
+    model       = None      # Set on the classes built by load_model()
+    table_name  = None
     
     def _read_fields(self, fn):
         fields = {}
@@ -441,6 +674,8 @@ class Table():
         return fieldset
 
     def _record_is_deleted(self, data):
+        if self.deletion_marker_offset is None:
+            return False
         if data[self.deletion_marker_offset] == self.deletion_marker_value:
             return True
         else:
@@ -450,90 +685,233 @@ class Table():
         #TODO lookup bitfieldN:name
         self.fields[fieldid].add_lut(lut)
 
-    def load(self, data):
-        self.field_struct = struct.Struct(self.field_struct_string)
-
-        self.rows = []
+    def _record_bounds(self, i):
+        """Return (start, end) byte offsets of record i within the file"""
+        current_record_offset   = self.first_record_offset + (self.record_length * i)
+        current_record_end      = current_record_offset + self.record_length
+        return current_record_offset, current_record_end
+
+    def _record_digests(self, data, start=0, stop=None):
+        """Digest the raw bytes of every record (or of records [start, stop)),
+        so changed records can be found cheaply"""
+        if stop is None: stop = self.num_records
+        digests = []
+        for i in range(start, stop):
+            current_record_offset, current_record_end = self._record_bounds(i)
+            digests.append( hashlib.blake2b(data[current_record_offset:current_record_end], digest_size=16).digest() )
+        return digests
+
+    def field_ids(self):
+        """Ids of the fields of each Row, in order (raw bitfields excluded)"""
+        return [k for k, field in self.fields.items() if field.type != "bitfield"]
+
+    # The bulk accessors below read Row internals directly rather than going
+    # through the MutableMapping protocol once per key, and do not build the
+    # Fields of Rows that have not been touched yet.
+
+    def column(self, name):
+        """Values of one field for every live record, in record order"""
+        return [row._raw_value(name) for row in self.rows if not row._deleted]
+
+    def to_tuples(self, fields=None):
+        """One tuple of field values (default: all fields, in order) per live record"""
+        if fields is None: fields = self.field_ids()
+        return [tuple(row._raw_value(k) for k in fields) for row in self.rows if not row._deleted]
+
+    def to_dicts(self, fields=None):
+        """One dict of field id => value (default: all fields) per live record"""
+        if fields is None: fields = self.field_ids()
+        return [{k: row._raw_value(k) for k in fields} for row in self.rows if not row._deleted]
+
+    def iter_rows(self, data):
+        """Decode and yield (record index, Row) one record at a time, without keeping them"""
         for i in range(self.num_records):
-            if DEBUG:
-                print("i=", i)
-                print(self.fields)
-                pdb.set_trace()
-            ###fieldset = copy.deepcopy(self.fields)
-            row = Row(self.fields)
-            # TODO subset the data outside of here
-            current_record_offset   = self.first_record_offset + (self.record_length * i)
-            current_record_end      = current_record_offset + self.record_length
-
-            # Check for deletion marker:
-            row['deleted'] = self._record_is_deleted( data[current_record_offset: current_record_end] )
-            
-            if DEBUG: print("DEBUG: field_struct_string=", self.field_struct_string)
-            field_values =  self.field_struct.unpack( data[ current_record_offset:current_record_end ] )
-            fields_raw = dict(zip(self.field_names, field_values))
-            if DEBUG: print("fields_raw=", fields_raw)
+            yield i, self._load_record(data, i)
+
+    def _load_record(self, data, i):
+        """Decode record i of data into a new Row"""
+        if not 0 <= i < self.num_records:
+            raise IndexError("record {} out of range 0..{}".format(i, self.num_records - 1))
+        return self._rows_from_columns( *self.decode_columns(data, i, i+1) )[0]
+
+    def layout(self):
+        """Picklable description of the record layout, enough to rebuild the
+        Table in a worker process (see _decode_shard)"""
+        return (self.tabledef_fn, self.zero_value, self.first_record_offset, self.record_length,
+                self.deletion_marker_offset, self.deletion_marker_value)
+
+    def decode_columns(self, data, start, stop, field_ids=None):
+        """Decode records [start, stop) into compact per-field column buffers
+
+        Returns (deleted, columns). deleted holds one 0/1 octet per record.
+        columns maps each field id to an array('B') for octet and sub-octet
+        fields, or to the fixed-width values concatenated into one bytes object
+        for wider fields. Raw bitfields are already expanded into their subfields.
+        data may be any buffer, including a shared memory block.
+        If field_ids is given, only those columns are built.
+        """
+        field_struct = struct.Struct(self.field_struct_string)
+        view = memoryview(data)[self.first_record_offset + (self.record_length * start):
+                                self.first_record_offset + (self.record_length * stop)]
+        deleted = bytearray(stop - start)
+        for n in range(stop - start):
+            deleted[n] = self._record_is_deleted( view[n * self.record_length:(n+1) * self.record_length] )
+        raw_columns = list( zip(*field_struct.iter_unpack(view)) )
+        view.release()
+
+        columns = {}
+        for k, column in zip(self.field_names, raw_columns):
+            field = self.fields[k]
+            if field.type == "bitfield":
+                for cname in field.constituents:
+                    if field_ids is not None and cname not in field_ids:
+                        continue
+                    subfield = self.fields[cname]
+                    # Same MSB-first bit numbering as _expand_bitfields
+                    shift = 8 - (subfield.offset % 8) - subfield.bits
+                    bitmask = (2 ** subfield.bits) - 1
+                    columns[cname] = array.array('B', [(v >> shift) & bitmask for v in column])
+            elif field_ids is not None and k not in field_ids:
+                continue
+            elif type(column[0]) is int:
+                columns[k] = array.array('B', column)
+            else:
+                columns[k] = b''.join(column)
+        return bytes(deleted), columns
 
-            # Once a bitfield is expanded into its consituent subfields, mark for deletion
-            deletion_list = []
-            
-            # Iterate through every raw field from the record (row) and
-            # 1) expand bitfield (if it is)
-            # 2) enter its value into the Field in the Row object instance
-            # 3) validate the Field
-            for k,v in fields_raw.items():
-                if DEBUG: print("k,v=", k, v)
-                if self._expand_bitfields(k, v, row):
-                    # Has been expanded completely -- okay to remove (but not during iteration)
-                    deletion_list.append(k)
-                ###fieldset[k].value = v
-                row[k].value = v
-                ###fieldset[k].validate()
-                row[k].validate()
-
-            # Remove the raw bitfields
-            if DEBUG:
-                print("\nREMOVE RAW BITFIELDS:")
-                print("deletion_list: ", deletion_list)
-            for k in deletion_list:
-                ###del fieldset[k]
-                del row[k]
-            # Strip the leading "bitfieldN:" from subfield ids
-            ###fieldset = self._rename_bitfield_subfields(fieldset)
-            #row = self._rename_bitfield_subfields(row) # no longer necessary
+    def _rows_from_columns(self, deleted, columns):
+        """Rows for the output of decode_columns, each building its Fields on first use"""
+        return [Row.from_columns(self.fields, columns, n, bool(deleted[n])) for n in range( len(deleted) )]
 
-            if DEBUG:
+    def load_parallel(self, shm_name, executor, shard_records=250):
+        """Submit this table's records, in shards, for decoding in executor
+
+        The image must already be in the shared memory block shm_name.
+        Returns a callable which waits for the shards and fills self.rows
+        and self.record_digests.
+        """
+        layout = self.layout()
+        futures = []
+        for start in range(0, self.num_records, shard_records):
+            stop = min(start + shard_records, self.num_records)
+            futures.append( executor.submit(_decode_shard, shm_name, layout, start, stop) )
+
+        def collect():
+            self.rows = []
+            self.record_digests = []
+            for future in futures:
+                deleted, columns, digests = future.result()
+                self.rows.extend( self._rows_from_columns(deleted, columns) )
+                self.record_digests.extend(digests)
+        return collect
+
+    def load(self, data):
+        self.rows = self._rows_from_columns( *self.decode_columns(data, 0, self.num_records) )
+        self.record_digests = self._record_digests(data)
+        if DEBUG:
+            for row in self.rows:
                 print("row post load =")
                 pprint.pprint( row )
                 print( list(row.keys()) )
-                #pdb.set_trace()
-            ###self.rows.append( fieldset )
-            self.rows.append( row )
+
+    def reload(self, data):
+        """Re-decode only the records whose bytes changed since the last (re)load
+
+        Every record is still digested, but only records whose digest differs
+        are decoded again, so the cost follows the size of the edit.
+        Returns a list of (record index, old row, new row).
+        """
+        changed = []
+        digests = self._record_digests(data)
+        for i, (old_digest, new_digest) in enumerate( zip(self.record_digests, digests) ):
+            if old_digest != new_digest:
+                old_row = self.rows[i]
+                self.rows[i] = self._load_record(data, i)
+                changed.append( (i, old_row, self.rows[i]) )
+        self.record_digests = digests
+        return changed
     
-    def dump(self):
-        pass
+    def blank_record(self):
+        """An empty (deleted) record: zero_value throughout plus the deletion marker"""
+        record = bytearray([self.zero_value]) * self.record_length
+        if self.deletion_marker_offset is not None:
+            record[self.deletion_marker_offset] = self.deletion_marker_value
+        return record
+
+    def encode_values(self, values, base):
+        """Encode a dict of field id => raw value over base, the record's current bytes
+
+        Bits not covered by values (including undocumented ones) keep their
+        value from base.
+        """
+        record = bytearray(base)
+        for k, v in values.items():
+            patch_bytes(record, *self.fields[k].encode(v))
+        return record
+
+    def encode_record(self, row, base):
+        """Encode a Row over base, the record's current bytes"""
+        record = self.encode_values({k: row[k].value for k in row}, base)
+        if row['deleted'] and self.deletion_marker_offset is not None:
+            record[self.deletion_marker_offset] = self.deletion_marker_value
+        return record
+
+    def dump(self, data):
+        """Encode self.rows back into data, a bytearray holding the whole image"""
+        for i, row in enumerate(self.rows):
+            current_record_offset, current_record_end = self._record_bounds(i)
+            data[current_record_offset:current_record_end] = \
+                self.encode_record(row, data[current_record_offset:current_record_end])
     
-    def __init__(self, tabledef_fn):
-        self._read_fields(tabledef_fn)
+    def __init__(self, tabledef_fn=None):
+        if tabledef_fn is None:
+            if getattr(self, 'tabledef_fn', None) is None:
+                self._use_default_layout()
+            tabledef_fn = self.tabledef_fn
+        # Parsing the CSV is done once per layout; each instance gets its own
+        # Field objects since add_lut modifies them
+        layout_key = (tabledef_fn, self.zero_value)
+        if layout_key not in _compiled_layouts:
+            self._read_fields(tabledef_fn)
+            _compiled_layouts[layout_key] = (self.field_names, self.field_struct_string, self.fields)
+        field_names, self.field_struct_string, fields = _compiled_layouts[layout_key]
+        self.field_names = list(field_names)
+        self.fields = copy.deepcopy(fields)
         #self._expand_bitfields()
     
+    def _use_default_layout(self):
+        # A base class such as Channel used directly, as before load_model()
+        # existed: take the layout of the default model's table of that kind
+        for table_name, base in table_bases.items():
+            if isinstance(self, base):
+                model_class = load_model(default_model)[table_name]
+                for k in ('tabledef_fn', 'num_records', 'first_record_offset', 'record_length', 'zero_value',
+                          'deletion_marker_offset', 'deletion_marker_value'):
+                    setattr(self, k, getattr(model_class, k))
+                return
+        raise TypeError("{} has no record layout; use the table classes from load_model()".format(
+            type(self).__name__))
+
+    def __reduce__(self):
+        # The classes built by load_model() are not module attributes, so
+        # pickle (e.g. to return an RDTFile from a process pool) cannot find
+        # them by name; record the model and table name to look them up by.
+        if self.model is None:
+            return (copyreg.__newobj__, (type(self),), self.__dict__)
+        return (_new_model_table, (self.model, self.table_name), self.__dict__)
+
     @property
     def end_record_offset(self):
         return self.first_record_offset + self.record_length
 
-class Channel(Table):
-    tabledef_fn = "fields_channel.csv"
-    num_records = 1000
-    first_record_offset = 127013
-    record_length = 64
-    #end_record_offset = first_record_offset + record_length
-    zero_value = 0xFF
-
-    deletion_marker_offset  = 16    # bytes
-    deletion_marker_value   = 0xFF
+# The layout of each table (offsets, record counts, ...) comes from the
+# model's tables.csv via load_model(); these classes only add what the
+# CSV cannot express, such as lookup tables.
 
+class Channel(Table):
     #channel_struct = struct.Struct("<c c c c c x h c B c B B x c x 4s 4s 2s 2s c c x x 32s")
     def __init__(self):
-        super().__init__(Channel.tabledef_fn)
+        super().__init__()
 
         self.add_lut("squelch", {0: 'tight', 1: 'normal'})
         self.add_lut("bandwidth", {0: "12.5 kHz", 1: "25 kHz"})
@@ -548,85 +926,29 @@ class Channel(Table):
 
 
 class Contact(Table):
-    tabledef_fn = "fields_contact.csv"
-    num_records = 1000
-    first_record_offset = 24997
-    record_length = 36
-    #end_record_offset = first_record_offset + record_length
-    zero_value = 0xFF
+    # TODO: deletion marker technically shoudl be bits 32 and 40 (bytes 4 and 4)
 
-    deletion_marker_offset  = 4         # TODO: technically shoudl be bits 32 and 40 (bytes 4 and 4)
-    deletion_marker_value   = 0x00
-
-    def __init__(self):
-        super().__init__(Contact.tabledef_fn)
+    # New contacts start from this, as written by the vendor CPS:
+    # call id unset, octet 3 = 0b11000001 (group call, no receive tone), empty name
+    new_record_template = bytes([0xFF, 0xFF, 0xFF, 0xC1]) + bytes(32)
 
 class RxGroup(Table):
-    tabledef_fn = "fields_rxgroup.csv"
-    num_records = 250
-    first_record_offset = 60997
-    record_length = 96
-    #end_record_offset = first_record_offset + record_length
-    zero_value = 0x00
-
-    deletion_marker_offset  = 0
-    deletion_marker_value   = 0x00
-
-    def __init__(self):
-        super().__init__(RxGroup.tabledef_fn)
+    pass
 
 class Scanlist(Table):
-    tabledef_fn = "fields_scanlist.csv"
-    num_records = 250
-    first_record_offset = 100997
-    record_length = 104
-    zero_value = 0x00
-
-    deletion_marker_offset  = 0
-    deletion_marker_value   = 0x00
-
-    def __init__(self):
-        super().__init__(Scanlist.tabledef_fn)
+    pass
 
 class Textmessage(Table):
-    tabledef_fn = "fields_textmsg.csv"
-    num_records = 50
-    first_record_offset = 9125
-    record_length = 288
-    zero_value = 0x00
-
-    deletion_marker_offset  = 0
-    deletion_marker_value   = 0x00
-
-    def __init__(self):
-        super().__init__(Textmessage.tabledef_fn)
+    pass
 
 class Zone(Table):
-    tabledef_fn = "fields_zone.csv"
-    num_records         = 250
-    first_record_offset = 84997
-    record_length       = 64
-    zero_value          = 0x00
-
-    deletion_marker_offset  = 0
-    deletion_marker_value   = 0x00
-
-    def __init__(self):
-        super().__init__(Zone.tabledef_fn)
-    
+    pass
 
 class Settings(Table):
-    tabledef_fn = "fields_settings.csv"
-    num_recods = 1
-    first_record_offset = 8805
-    record_length = 144
-    zero_value = 0xFF
-
-    deletion_marker_offset  = 0x00  # Not really sure best way to do this,
-    deletion_marker_value   = 0x01  # since Settings has only one row / can't be del'd
+    # Settings has only one row and can't be deleted: its deletion marker is blank in tables.csv
 
     def __init__(self):
-        super().__init__(Settings.tabledef_fn)
+        super().__init__()
 
         # At this point the RDT file has not been loaded, 
         # so bitfield-subfield fields have not been renamed yet
@@ -640,6 +962,76 @@ class Settings(Table):
         self.add_lut("keypad_lock_time", {1: "5 sec", 2: "10 sec", 3: "15 sec", 255: "manual"})
         self.add_lut("mode", {0: "MR", 255: "CH" } )
 
+# tables.csv "table" column => class the model's table is built on
+table_bases = {
+    'settings':     Settings,
+    'channels':     Channel,
+    'contacts':     Contact,
+    'rxgroups':     RxGroup,
+    'scanlists':    Scanlist,
+    'textmessages': Textmessage,
+    'zones':        Zone,
+}
+
+models_fn = os.path.join( os.path.dirname(os.path.abspath(__file__)), "models.csv" )
+_models = None          # model name => row of models.csv
+_model_tables = {}      # model name => {table name: Table subclass}
+
+def _csv_int(value):
+    return int(value, 0) if value.strip() else None
+
+def models():
+    """All radio models from models.csv (read once)"""
+    global _models
+    if _models is None:
+        with open(models_fn, 'r', newline='') as fi:
+            _models = {row['model']: row for row in csv.DictReader(fi)}
+    return _models
+
+def load_model(model):
+    """Table classes for a radio model, built from its tables.csv and cached
+
+    Returns {table name: class}, in tables.csv order. Each class is a subclass
+    of the table_bases entry carrying the layout from the CSV; its compiled
+    field layout is cached too (see Table.__init__).
+    """
+    if model not in _model_tables:
+        tables_fn = os.path.join( os.path.dirname(models_fn), models()[model]['tables_fn'] )
+        classes = {}
+        with open(tables_fn, 'r', newline='') as fi:
+            for row in csv.DictReader(fi):
+                base = table_bases[ row['table'] ]
+                classes[ row['table'] ] = type("{}_{}".format(model, base.__name__), (base,), {
+                    'model':                    model,
+                    'table_name':               row['table'],
+                    'tabledef_fn':              os.path.join( os.path.dirname(tables_fn), row['tabledef_fn'] ),
+                    'num_records':              _csv_int(row['num_records']),
+                    'first_record_offset':      _csv_int(row['first_record_offset']),
+                    'record_length':            _csv_int(row['record_length']),
+                    'zero_value':               _csv_int(row['zero_value']),
+                    'deletion_marker_offset':   _csv_int(row['deletion_marker_offset']),
+                    'deletion_marker_value':    _csv_int(row['deletion_marker_value']),
+                })
+        _model_tables[model] = classes
+    return _model_tables[model]
+
+def _new_model_table(model, table_name):
+    """Unpickle helper for Table.__reduce__: an uninitialized table of a model"""
+    table_class = load_model(model)[table_name]
+    return table_class.__new__(table_class)
+
+def detect_model(file_contents):
+    """Name of the radio model whose file size (and header, if listed) matches"""
+    for model, row in models().items():
+        if len(file_contents) != int(row['file_size']):
+            continue
+        if row['header'] and not bytes(file_contents[:len(row['header']) // 2]) == bytes.fromhex(row['header']):
+            continue
+        return model
+    raise ValueError("Unrecognized codeplug: {} bytes".format(len(file_contents)))
+
+default_model = "md380"
+
 class GeneralSettings(Table):
     tabledef_fn = "fields_settings.csv"
     first_record_offset = 8805
@@ -794,29 +1186,1032 @@ class GeneralSettings(Table):
     info_line1 = property(_get_info1, _set_info1)
     info_line2 = property(_get_info2, _set_info2)
 
+# Tables rebuilt inside worker processes, keyed by Table.layout()
+_shard_tables = {}
+
+def _decode_shard(shm_name, layout, start, stop):
+    """Process pool worker: decode and digest records [start, stop) of the image in shared memory
+
+    Returns (deleted, columns, digests).
+    """
+    if layout not in _shard_tables:
+        table = Table.__new__(Table)
+        (table.tabledef_fn, table.zero_value, table.first_record_offset, table.record_length,
+         table.deletion_marker_offset, table.deletion_marker_value) = layout
+        table._read_fields(table.tabledef_fn)
+        _shard_tables[layout] = table
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name, track=False)   # Python >= 3.13
+    except TypeError:
+        # Older Pythons register the block again on attach. Workers share the
+        # parent's resource tracker (see decode_pool), where that is a no-op;
+        # the parent unregisters the block once, when it unlinks it.
+        shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        table = _shard_tables[layout]
+        return table.decode_columns(shm.buf, start, stop) + (table._record_digests(shm.buf, start, stop),)
+    finally:
+        shm.close()
+
+def decode_pool(jobs):
+    """A process pool of jobs workers for load_tables_parallel()
+
+    The resource tracker is started before any worker, so that they all
+    share the parent's instead of each starting one that would unlink the
+    shared memory block when the worker exits.
+    """
+    resource_tracker.ensure_running()
+    return concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+
+def load_tables_parallel(tables, file_contents, executor, shard_records=250):
+    """Decode several tables of one image in executor (a process pool)
+
+    The image is copied once into shared memory, which the workers map
+    instead of receiving a pickled copy per shard.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=len(file_contents))
+    try:
+        shm.buf[:len(file_contents)] = file_contents
+        collectors = [table.load_parallel(shm.name, executor, shard_records) for table in tables]
+        for collect in collectors:
+            collect()
+    finally:
+        shm.close()
+        shm.unlink()
+
+# One change seen by RDTFile.watch(). record is 1-indexed, as in `list` output.
+# field is None when the whole record was added or deleted.
+ChangeEvent = namedtuple("ChangeEvent", ["table", "record", "field", "old", "new"])
+
+def format_change_event(event):
+    if event.field is None:
+        return "{} {} {}".format(event.table, event.record, event.new)
+    return "{} {} {} changed: {} -> {}".format(event.table, event.record, event.field, event.old, event.new)
+
 class RDTFile():
-    def __init__(self, fn):
-        self.settings   = Settings()
-        self.channels   = Channel()
-        self.contacts   = Contact()
-        self.rxgroups   = RxGroup()
-        self.scanlists  = Scanlist()
-        self.textmessages = Textmessage()
-        self.zones      = Zone()
-
-        with open(fn, "rb") as fi:
+    def __init__(self, fn, executor=None, file_contents=None, quiet=False):
+        """Load an RDT file; if executor (a process pool, see decode_pool) is given, decode in parallel
+
+        file_contents may be passed if the file has already been read.
+        The radio model is detected from the file, and each of its tables
+        becomes an attribute (self.channels, self.zones, ...).
+        """
+        self.fn = fn
+        self._stat = self._stat_file()
+        if file_contents is None:
+            with open(fn, "rb") as fi:
+                file_contents = fi.read()
+        self.file_contents = file_contents
+
+        self.model = detect_model(file_contents)
+        self.table_names = tuple( load_model(self.model) )
+        for table_name, table_class in load_model(self.model).items():
+            setattr(self, table_name, table_class())
+
+        if not quiet: print("Loading {}...".format(fn), end='', flush=True)
+        if executor:
+            load_tables_parallel([getattr(self, t) for t in self.table_names], file_contents, executor)
+        else:
+            for table_name in self.table_names:
+                getattr(self, table_name).load(file_contents)
+
+        if not quiet: print("ok\n")
+
+    def _stat_file(self):
+        st = os.stat(self.fn)
+        return (st.st_mtime_ns, st.st_size)
+
+    def reload(self):
+        """Re-read the file if its mtime or size changed, re-decoding only changed records
+
+        Returns a list of ChangeEvent (empty if the file is unchanged).
+        """
+        stat = self._stat_file()
+        if stat == self._stat:
+            return []
+
+        with open(self.fn, "rb") as fi:
             file_contents = fi.read()
+        if detect_model(file_contents) != self.model:
+            raise ValueError("{} is no longer a {} codeplug".format(self.fn, self.model))
+        # Only now, so that a failed read is retried on the next call
+        self._stat = stat
+        self.file_contents = file_contents
+
+        events = []
+        for table_name in self.table_names:
+            table = getattr(self, table_name)
+            for i, old_row, new_row in table.reload(file_contents):
+                if old_row['deleted'] != new_row['deleted']:
+                    status = "deleted" if new_row['deleted'] else "added"
+                    events.append( ChangeEvent(table_name, i+1, None, None, status) )
+                    continue
+                if new_row['deleted']:
+                    continue    # changes within a deleted slot are of no interest
+                for k in new_row:
+                    if old_row[k].value != new_row[k].value:
+                        events.append( ChangeEvent(table_name, i+1, k, old_row[k], new_row[k]) )
+        return events
+
+    def watch(self, interval=1.0):
+        """Poll the file forever, yielding a ChangeEvent for each change found
+
+        A poll that cannot read the file (missing, or not a codeplug of the
+        same model, e.g. while the CPS is still writing it) is skipped and
+        retried on the next interval.
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                events = self.reload()
+            except (OSError, ValueError):
+                continue
+            for event in events:
+                yield event
+
+# One row of a DMR user database (e.g. RadioID.net user.csv or md380tools users.csv)
+UserdbEntry = namedtuple("UserdbEntry", ["call_id", "callsign", "name", "city", "state", "country"])
+
+# Header names seen in the wild => UserdbEntry field
+_userdb_columns = {
+    "radio_id": "call_id", "id": "call_id", "dmr_id": "call_id",
+    "callsign": "callsign",
+    "name": "name", "first_name": "name",
+    "city": "city", "state": "state", "country": "country",
+}
+
+def read_userdb(fn):
+    """Stream UserdbEntry rows from a DMR user database CSV, one at a time
+
+    A header row is used to locate the columns if present; header-less files
+    are assumed to be in md380tools order (id,callsign,name,city,state,nick,country).
+    Rows without a numeric id are skipped.
+    """
+    with open(fn, 'r', newline='', encoding='utf-8', errors='replace') as fi:
+        reader = csv.reader(fi)
+        first = next(reader, None)
+        if first is None:
+            return
+        if first[0].strip().isdigit():
+            columns = {"call_id": 0, "callsign": 1, "name": 2, "city": 3, "state": 4, "country": 6}
+            reader = itertools.chain([first], reader)
+        else:
+            columns = {}
+            for n, heading in enumerate(first):
+                key = _userdb_columns.get( heading.strip().lower() )
+                if key and key not in columns:
+                    columns[key] = n
+        for row in reader:
+            values = {k: (row[n].strip() if n < len(row) else "") for k, n in columns.items()}
+            if not values.get("call_id", "").isdigit():
+                continue
+            values["call_id"] = int(values["call_id"])
+            yield UserdbEntry(**{k: values.get(k, "") for k in UserdbEntry._fields})
+
+def select_contacts(entries, limit, regions=(), prefixes=(), priority=()):
+    """Pick the best limit entries from a stream, holding at most limit in memory
+
+    regions:  if given, only entries whose state or country is listed are kept
+    prefixes: entries whose callsign starts with one of these rank higher
+    priority: call ids or callsigns ranked above everything else, in list order
+    Ties go to the entry seen first. Entries are deduplicated by call_id,
+    first occurrence wins. Returns the chosen entries, best first.
+    """
+    regions  = {r.lower() for r in regions}
+    prefixes = tuple(p.upper() for p in prefixes)
+    priority_rank = {}
+    for n, key in enumerate(priority):
+        priority_rank.setdefault(str(key).upper(), len(priority) - n)
+
+    if limit <= 0:
+        return []
+    heap = []       # min-heap of (rank, entry): heap[0] is the worst kept so far
+    seen = set()
+    for seq, entry in enumerate(entries):
+        if regions and entry.state.lower() not in regions and entry.country.lower() not in regions:
+            continue
+        if entry.call_id in seen:
+            continue
+        seen.add(entry.call_id)
+        rank = (max(priority_rank.get(str(entry.call_id), 0), priority_rank.get(entry.callsign.upper(), 0)),
+                entry.callsign.upper().startswith(prefixes) if prefixes else False,
+                -seq)
+        if len(heap) < limit:
+            heapq.heappush(heap, (rank, entry))
+        elif rank > heap[0][0]:
+            heapq.heapreplace(heap, (rank, entry))
+    return [entry for rank, entry in sorted(heap, reverse=True)]
+
+def encode_userdb_contacts(table, entries, data, replace=False):
+    """Encode entries as private call contacts into the Contact table of data (a bytearray)
+
+    By default the entries go into free (deleted) slots, in order, and the
+    existing contacts are kept. With replace, every slot is rewritten: the
+    entries from the first slot on, and the remaining slots blanked.
+    Names are cut to the name field on a character boundary. A name whose
+    first octet would be 0x00 (e.g. an empty one) reads back as deleted, so
+    the call id is put in front.
+    Returns the slots written, in entry order. Raises ValueError if there
+    are more entries than slots.
+    """
+    if replace:
+        slots = list( range(table.num_records) )
+    else:
+        slots = [i for i in range(table.num_records) if table._record_is_deleted( data[slice(*table._record_bounds(i))] )]
+    if len(entries) > len(slots):
+        raise ValueError("{} contacts do not fit in {} {}records".format(
+            len(entries), len(slots), "" if replace else "free "))
+    name_octets = table.fields['name'].bits // 8
+    for n, i in enumerate(slots):
+        current_record_offset, current_record_end = table._record_bounds(i)
+        if n < len(entries):
+            entry = entries[n]
+            name = "{} {}".format(entry.callsign, entry.name).strip()
+            if name.encode('utf-16-le')[:1] in (b'', b'\x00'):
+                name = "{} {}".format(entry.call_id, name).strip()
+            name = name.encode('utf-16-le')
+            if len(name) > name_octets:
+                name = name[:name_octets]
+                if 0xD8 <= name[-1] <= 0xDB:    # don't keep half of a surrogate pair
+                    name = name[:-2]
+            name = name.ljust(name_octets, b'\x00')
+            record = table.encode_values({
+                'call_id':  entry.call_id,
+                'call_type': 2,         # private call
+                'call_receive_tone': 0,
+                'name':     name,
+            }, table.new_record_template)
+        elif replace:
+            record = table.blank_record()
+        else:
+            break
+        data[current_record_offset:current_record_end] = record
+    return slots[:len(entries)]
+
+def contact_references(tables, num_contacts):
+    """Live records that refer to each contact slot
+
+    tables maps table names to loaded Tables (e.g. channels and rxgroups);
+    the fields table_references lists as pointing at contacts are read.
+    Returns {contact slot (0-indexed): [(table name, record index, field id)]}.
+    """
+    references = {}
+    for table_name, table in tables.items():
+        field_ids = [k for k, target in table_references.get(table_name, {}).items() if target == 'contacts']
+        for i, row in enumerate(table.rows):
+            if row['deleted']:
+                continue
+            for field_id in field_ids:
+                value = int.from_bytes(row._raw_value(field_id), "little")
+                if 1 <= value <= num_contacts:
+                    references.setdefault(value - 1, []).append( (table_name, i, field_id) )
+    return references
+
+def _read_file(fn):
+    with open(fn, "rb") as fi:
+        return fi.read()
+
+def _load_rdtfile(fn, file_contents):
+    # Module level so that it can be sent to a process pool
+    return RDTFile(fn, file_contents=file_contents, quiet=True)
+
+async def load_many(paths, concurrency=4, executor=None):
+    """Load many RDT files without blocking the event loop
+
+    Files are read in a pool of concurrency threads and decoded in executor
+    (None means the loop's default executor; pass a ProcessPoolExecutor to
+    decode on several cores). At most concurrency files are in flight, and a
+    new one is only started once the caller has taken a finished result, so a
+    slow consumer throttles the loading.
+
+    Yields (path, result) in completion order, where result is the RDTFile
+    or the exception raised while loading that one file.
+
+        async for path, result in load_many(paths, concurrency=8):
+            if isinstance(result, Exception): ...
+    """
+    loop = asyncio.get_running_loop()
+    paths = iter(paths)
+    pending = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as io_executor:
+        async def load(path):
+            file_contents = await loop.run_in_executor(io_executor, _read_file, path)
+            return await loop.run_in_executor(executor, _load_rdtfile, path, file_contents)
+
+        def start_next():
+            for path in paths:
+                pending[ asyncio.ensure_future(load(path)) ] = path
+                return
+
+        for _ in range(concurrency):
+            start_next()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    path = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        result = e
+                    yield path, result
+                    start_next()
+        finally:
+            for task in pending:
+                task.cancel()
+
+# Table name (as used on the command line) => Table class, for the default model
+table_classes = load_model(default_model)
+
+# One edit compiled to bytes: record is a 0-indexed record number, or None
+# for every live record; offset is relative to the start of the record.
+Patch = namedtuple("Patch", ["table", "record", "field", "offset", "mask", "bits", "value"])
+
+def compile_edits(lines, model=default_model):
+    """Compile edits of the form table:row:field=value into Patches for a model
+
+    row is 1-indexed as in `list` output, or * for every live record, and may
+    be left out for single-record tables (settings:radio_name=...). Blank
+    lines and lines starting with # are ignored. Raises ValueError on the
+    first bad edit, naming it.
+    """
+    table_classes = load_model(model)
+    tables = {}
+    patches = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            target, text = line.split('=', 1)
+            parts = target.strip().split(':')
+            if len(parts) == 2:
+                parts.insert(1, "1")
+            table_name, row, field_id = parts
+            if table_name not in tables:
+                tables[table_name] = table_classes[table_name]()
+            table = tables[table_name]
+            field = table.fields[field_id]
+            if field.type == "bitfield":
+                raise KeyError(field_id)
+            if row == '*':
+                record = None
+            else:
+                record = int(row) - 1
+                if not 0 <= record < table.num_records:
+                    raise ValueError("row {} out of range 1..{}".format(row, table.num_records))
+            value = field.parse(text)
+            patches.append( Patch(table, record, field_id, *field.encode(value), value) )
+        except KeyError as e:
+            raise ValueError("{}: unknown table or field {}".format(line, e))
+        except ValueError as e:
+            raise ValueError("{}: {}".format(line, e))
+    return patches
+
+# (edit lines, model) => Patches, so mixed-model fleets compile once per model
+_compiled_edits = {}
+
+def apply_patches(fn, edits):
+    """Apply edits (lines as for compile_edits) to one RDT file in a single pass
+
+    The edits are compiled once per radio model and cached. Wildcard patches
+    touch every live record; an explicit row that is deleted in this file is
+    an error. Every touched field is decoded again and checked before the
+    file is replaced (atomically). Returns the number of records changed;
+    the file is not rewritten if nothing changed.
+    """
+    data = bytearray( _read_file(fn) )
+    original = bytes(data)
+    compile_key = ( tuple(edits), detect_model(data) )
+    if compile_key not in _compiled_edits:
+        _compiled_edits[compile_key] = compile_edits(*compile_key)
+    patches = _compiled_edits[compile_key]
+    live = {}       # table => live record numbers, found once per file
+    touched = {}    # table => {field id: {record: expected value}}
+    for patch in patches:
+        table = patch.table
+        if patch.record is None:
+            if table not in live:
+                live[table] = [i for i in range(table.num_records)
+                               if not table._record_is_deleted( data[slice(*table._record_bounds(i))] )]
+            records = live[table]
+        else:
+            if table._record_is_deleted( data[slice(*table._record_bounds(patch.record))] ):
+                raise ValueError("{} row {} is deleted".format(patch.field, patch.record + 1))
+            records = [patch.record]
+        offset = table.first_record_offset + patch.offset
+        expected = touched.setdefault(table, {}).setdefault(patch.field, {})
+        for i in records:
+            patch_bytes(data, offset + (table.record_length * i), patch.mask, patch.bits)
+            expected[i] = patch.value
+
+    # Validate: decode what was written and compare with what was asked for
+    changed = 0
+    for table, expected_by_field in touched.items():
+        records = set()
+        for expected in expected_by_field.values():
+            records.update(expected)
+        if not records:
+            continue    # wildcard edits of a table with no live records
+        first, stop = min(records), max(records) + 1
+        deleted, columns = table.decode_columns(data, first, stop, expected_by_field)
+        for field_id, expected in expected_by_field.items():
+            column = columns[field_id]
+            width = table.fields[field_id].bits // 8
+            for i, value in expected.items():
+                if type(column) is bytes:
+                    decoded = column[(i - first) * width:(i - first + 1) * width]
+                else:
+                    decoded = column[i - first]
+                if decoded != value:
+                    raise ValueError("{} row {} reads back as {!r}, expected {!r} (conflicting edits?)".format(
+                        field_id, i + 1, decoded, value))
+        for i in records:
+            if deleted[i - first]:
+                raise ValueError("row {}: edits mark the record as deleted".format(i + 1))
+            start, end = table._record_bounds(i)
+            if data[start:end] != original[start:end]:
+                changed += 1
+
+    if changed:
+        atomic_write(fn, data)
+    return changed
+
+def _apply_patches_report(fn, edits):
+    # Process pool worker: one line of report per file, never raises
+    try:
+        return "{}: {} records changed".format(fn, apply_patches(fn, edits)), True
+    except (OSError, ValueError) as e:
+        return "{}: ERROR {} (file left unchanged)".format(fn, e), False
+
+# Decoded Channel columns which, together, say what a channel does on the air
+channel_key_fields = ('channel_mode', 'rx_frequency', 'tx_frequency', 'color_code', 'time_slot',
+                      'ctcss_dcs_decode', 'ctcss_dcs_encode')
+
+def channel_keys(table, data):
+    """Return [(record index, key)] for every live channel in data
+
+    key is a tuple of channel_key_fields values, with rx/tx frequency decoded
+    to ints (units of 10 Hz) so keys can be sorted by frequency.
+    """
+    deleted, columns = table.decode_columns(data, 0, table.num_records, channel_key_fields)
+    key_columns = []
+    for k in channel_key_fields:
+        column = columns[k]
+        if type(column) is bytes:
+            width = table.fields[k].bits // 8
+            column = [column[n:n + width] for n in range(0, len(column), width)]
+            if table.fields[k].type == "bcd":
+                column = [bcd_decode(v) for v in column]
+        key_columns.append(column)
+    return [(i, key) for i, key in enumerate(zip(*key_columns)) if not deleted[i]]
+
+def find_offset_conflicts(pairs, tolerance=0):
+    """Find (rx, tx) frequency pairs that share an rx frequency but not a tx frequency
+
+    pairs is any iterable of (rx, tx); rx frequencies within tolerance of each
+    other count as shared. Sorts the distinct pairs once and scans runs of
+    shared rx, so the cost is O(n log n). Returns a list of conflicting groups,
+    each a sorted list of distinct (rx, tx).
+    """
+    distinct = sorted( set(pairs) )
+    conflicts = []
+    run = []
+    for pair in distinct + [None]:
+        if pair is not None and run and pair[0] - run[-1][0] <= tolerance:
+            run.append(pair)
+            continue
+        if len( set(tx for rx, tx in run) ) > 1:
+            conflicts.append(run)
+        run = [pair]
+    return conflicts
+
+def analyze_channels(table, data, tolerance=0):
+    """Find duplicate channels and offset conflicts in one image
+
+    Returns (keys, duplicates, conflicts): keys as from channel_keys;
+    duplicates is a list of lists of record indices with identical keys;
+    conflicts is as from find_offset_conflicts, with each (rx, tx) mapped
+    to the record indices using it.
+    """
+    keys = channel_keys(table, data)
+    by_key = {}
+    by_pair = {}
+    for i, key in keys:
+        by_key.setdefault(key, []).append(i)
+        by_pair.setdefault((key[1], key[2]), []).append(i)
+    duplicates = [records for records in by_key.values() if len(records) > 1]
+    conflicts = [[(pair, by_pair[pair]) for pair in group]
+                 for group in find_offset_conflicts(by_pair, tolerance)]
+    return keys, duplicates, conflicts
+
+def _mhz(freq):
+    return "{:.5f}".format(freq / 100000)
+
+def analyze_channels_fleet(fns, tolerance=0, top=10):
+    """Run analyze_channels over each file, one at a time, and summarize the fleet
+
+    Per file only the Channel columns are decoded. Across the fleet only the
+    number of files using each distinct key is kept, so memory follows the
+    number of distinct channels rather than the number of files.
+    """
+    tables = {}                         # model => Channel table
+    key_files = collections.Counter()   # key => number of files using it
+    files = 0
+    for fn in fns:
+        try:
+            data = _read_file(fn)
+        except OSError as e:
+            print("{}: ERROR {}".format(fn, e))
+            continue
+        try:
+            model = detect_model(data)
+        except ValueError as e:
+            print("{}: ERROR {}".format(fn, e))
+            continue
+        if model not in tables:
+            tables[model] = load_model(model)['channels']()
+        files += 1
+        keys, duplicates, conflicts = analyze_channels(tables[model], data, tolerance)
+        print("{}: {} channels, {} duplicate groups, {} offset conflicts".format(
+            fn, len(keys), len(duplicates), len(conflicts)))
+        for records in duplicates:
+            print("  duplicate: channels {}".format(", ".join(str(i + 1) for i in records)))
+        for group in conflicts:
+            print("  offset conflict: {}".format("; ".join(
+                "rx {} tx {} (channels {})".format(_mhz(rx), _mhz(tx), ", ".join(str(i + 1) for i in records))
+                for (rx, tx), records in group)))
+        key_files.update( set(key for i, key in keys) )
+
+    if files > 1:
+        print("\nFleet: {} files, {} distinct channels".format(files, len(key_files)))
+        print("Most widespread:")
+        for key, count in key_files.most_common(top):
+            print("  {:4d} files: rx {} tx {} cc {} ts {}".format(count, _mhz(key[1]), _mhz(key[2]), key[3], key[4]))
+        conflicts = find_offset_conflicts( ((key[1], key[2]) for key in key_files), tolerance )
+        print("Offset conflicts across the fleet: {}".format(len(conflicts)))
+        for group in conflicts:
+            print("  {}".format("; ".join("rx {} tx {}".format(_mhz(rx), _mhz(tx)) for rx, tx in group)))
+
+# Fields holding a 1-indexed record number in another table. 0 means none,
+# and values above the target's num_records are special markers; both are
+# left as they are when records are renumbered.
+table_references = {
+    'channels':  {'contact_name': 'contacts', 'scan_list': 'scanlists', 'group_list': 'rxgroups'},
+    'rxgroups':  {"contact{:02d}".format(n): 'contacts' for n in range(1, 33)},
+    'scanlists': dict( {'prio_channel1': 'channels', 'prior_channel2': 'channels', 'tx_channel': 'channels'},
+                       **{"channel{:02d}".format(n): 'channels' for n in range(1, 32)} ),
+    'zones':     {"channel{:02d}".format(n): 'channels' for n in range(1, 17)},
+}
+
+# Tables are merged so that every reference points at an already merged table,
+# except channels => scanlists, which points "forward" and is fixed up last.
+merge_order = ('contacts', 'rxgroups', 'channels', 'scanlists', 'zones')
+
+def _read_reference(field, record):
+    return int.from_bytes(record[field.byte_offset:field.byte_offset + (field.bits // 8)], "little")
+
+def merge_images(images):
+    """Merge the tables in merge_order from several images (bytes) into one
+
+    Live records are renumbered as they are packed into the slots of the
+    merged table, and their references are rewritten through per-image remap
+    arrays (old record number => new). Records identical after remapping are
+    stored once. Records that do not fit are dropped, and references to them
+    are cleared. Everything else (settings, text messages) comes from the first image.
+
+    Channels which differ only in their scan list are merged, keeping the
+    first one's scan list.
+
+    Returns (merged image, {table name: (unique records, dropped records, slots)}).
+    """
+    model = detect_model(images[0])
+    for data in images[1:]:
+        if detect_model(data) != model:
+            raise ValueError("Cannot merge codeplugs of different models ({} and {})".format(model, detect_model(data)))
+    merged = bytearray(images[0])
+    tables = {name: load_model(model)[name]() for name in merge_order}
+    remap = [{} for data in images]     # per image: table name => array('H') of new numbers
+    forward = []                        # (table, new index, field id, target, image number, old value)
+    report = {}
+
+    for name in merge_order:
+        table = tables[name]
+        references = table_references.get(name, {})
+        seen = {}       # record bytes => new record number
+        records = []
+        dropped = 0
+        for n, data in enumerate(images):
+            new_numbers = array.array('H', bytes(2 * (table.num_records + 1)))
+            for i in range(table.num_records):
+                current_record_offset, current_record_end = table._record_bounds(i)
+                record = bytearray(data[current_record_offset:current_record_end])
+                if table._record_is_deleted(record):
+                    continue
+                forward_refs = []
+                for field_id, target in references.items():
+                    field = table.fields[field_id]
+                    old = _read_reference(field, record)
+                    if not 0 < old <= tables[target].num_records:
+                        continue
+                    if target in remap[n]:
+                        new = remap[n][target][old]
+                    else:
+                        forward_refs.append( (field_id, target, old) )
+                        new = 0
+                    patch_bytes(record, *field.encode(new))
+                key = bytes(record)
+                if key in seen:
+                    new_numbers[i + 1] = seen[key]
+                    continue
+                if len(records) == table.num_records:
+                    dropped += 1
+                    continue
+                records.append(record)
+                seen[key] = new_numbers[i + 1] = len(records)
+                for field_id, target, old in forward_refs:
+                    forward.append( (table, len(records) - 1, field_id, target, n, old) )
+            remap[n][name] = new_numbers
+
+        for i in range(table.num_records):
+            current_record_offset, current_record_end = table._record_bounds(i)
+            merged[current_record_offset:current_record_end] = records[i] if i < len(records) else table.blank_record()
+        report[name] = (len(records) + dropped, dropped, table.num_records)
+
+    for table, i, field_id, target, n, old in forward:
+        offset, mask, bits = table.fields[field_id].encode( remap[n][target][old] )
+        patch_bytes(merged, table._record_bounds(i)[0] + offset, mask, bits)
+    return merged, report
+
+def compile_utf16_search(pattern, ignore_case=False, regex=False):
+    """Compile a search pattern for grep_image
+
+    A fixed string becomes a bytes regex over its UTF-16LE encoding (with
+    ignore_case, each character matches either case), so table regions are
+    searched as raw bytes. With regex, pattern is a str regex which is run
+    against the text of each field.
+    """
+    if regex:
+        return re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    parts = []
+    for ch in pattern:
+        variants = {ch, ch.lower(), ch.upper()} if ignore_case else {ch}
+        encoded = sorted( re.escape(v.encode('utf-16-le')) for v in variants if len(v) == 1 )
+        parts.append( encoded[0] if len(encoded) == 1 else b"(?:" + b"|".join(encoded) + b")" )
+    return re.compile( b"".join(parts) )
+
+# High octet of a UTF-16LE surrogate code unit (see grep_image)
+_utf16_surrogate = re.compile(b"[\xd8-\xdf]")
+
+def grep_image(data, tables, pattern):
+    """Search the UTF-16 fields of the given tables of one image
+
+    tables maps table names to Table instances (only their layout is used)
+    and pattern comes from compile_utf16_search. For fixed strings, only the
+    fields that match are decoded. Returns a list of (table name, record index, field id, text)
+    for live records, at most one per field.
+    """
+    hits = []
+    for table_name, table in tables.items():
+        utf16_fields = [(field.byte_offset, field.bits // 8, field.id) for field in table.fields.values()
+                        if field.type == "utf16" or field.type == "unicode"]
+        if not utf16_fields:
+            continue
+        region = data[table.first_record_offset:table.first_record_offset + (table.num_records * table.record_length)]
+        if type(pattern.pattern) is str:
+            # Regular expressions: search each field's text on its own, so ^ and
+            # $ mean the field. The region is decoded in one go when every
+            # character is 2 octets: fields start on even offsets and no octet
+            # pair is a surrogate (a surrogate pair is one character from 4
+            # octets, which would misplace every later field). Otherwise each
+            # field is decoded separately.
+            text = None
+            if table.record_length % 2 == 0 and all(offset % 2 == 0 for offset, _, _ in utf16_fields) \
+                    and not _utf16_surrogate.search(region[1::2]):
+                text = region.decode('utf-16-le')
+            for i in range(table.num_records):
+                record = region[i * table.record_length:(i+1) * table.record_length]
+                if table._record_is_deleted(record):
+                    continue
+                for field_offset, field_octets, field_id in utf16_fields:
+                    if text is None:
+                        field_text = record[field_offset:field_offset + field_octets].decode('utf-16-le', errors='replace')
+                    else:
+                        field_start = ((i * table.record_length) + field_offset) // 2
+                        field_text = text[field_start:field_start + (field_octets // 2)]
+                    field_text = field_text.rstrip('\x00')
+                    if pattern.search(field_text):
+                        hits.append( (table_name, i, field_id, field_text) )
+            continue
+
+        pos = 0
+        while True:
+            m = pattern.search(region, pos)
+            if m is None:
+                break
+            i, within = divmod(m.start(), table.record_length)
+            for field_offset, field_octets, field_id in utf16_fields:
+                field_start = (i * table.record_length) + field_offset
+                # The match must start on a character boundary inside the field and end within it
+                if field_offset <= within < field_offset + field_octets and (within - field_offset) % 2 == 0 \
+                        and m.end() <= field_start + field_octets:
+                    record = region[i * table.record_length:(i+1) * table.record_length]
+                    if not table._record_is_deleted(record):
+                        text = region[field_start:field_start + field_octets].decode('utf-16-le', errors='replace')
+                        hits.append( (table_name, i, field_id, text.rstrip('\x00')) )
+                    pos = field_start + field_octets    # one hit per field is enough
+                    break
+            else:
+                pos = m.start() + 1
+    return hits
+
+# Per process: model => {table name: Table}, for grep_file
+_grep_tables = {}
+
+def grep_file(fn, pattern, table_names=None):
+    """grep_image on one file, as (fn, hits or the exception); usable in a process pool"""
+    try:
+        data = _read_file(fn)
+        model = detect_model(data)
+        if model not in _grep_tables:
+            _grep_tables[model] = {name: cls() for name, cls in load_model(model).items()}
+        tables = {name: table for name, table in _grep_tables[model].items()
+                  if table_names is None or name in table_names}
+        return fn, grep_image(data, tables, pattern)
+    except (OSError, ValueError) as e:
+        return fn, e
+
+# Non-ASCII characters for random UTF-16 text, so multi-octet code units are exercised
+_random_text_chars = "ABCXYZabcxyz0189 -./" + "\u00e4\u00e9\u00df\u03a9\u0416\u4e2d\u20ac"
+
+def random_field_value(field, rng):
+    """A random valid raw value for field, favouring edge cases
+
+    A quarter of the time an integer field gets 0 and another quarter its
+    largest value; BCDT tones cover CTCSS, DCS normal and inverted, and unset.
+    """
+    octets = field.bits // 8
+    if field.bits <= 8:
+        try:
+            if field.lut: return rng.choice( list(field.lut) )
+        except AttributeError:
+            pass
+        return rng.choice([0, (2 ** field.bits) - 1, rng.randrange(2 ** field.bits), rng.randrange(2 ** field.bits)])
+    if field.type == "ascii":
+        text = "".join( rng.choice("ABCXYZ0189") for _ in range(rng.randrange(octets + 1)) )
+        return text.encode('ascii').ljust(octets, b'\x00')
+    elif field.type == "unicode" or field.type == "utf16":
+        text = "".join( rng.choice(_random_text_chars) for _ in range(rng.randrange(octets // 2 + 1)) )
+        return text.encode('utf-16-le').ljust(octets, b'\x00')
+    elif field.type == "bcd":
+        return bytes( bcd_encode(rng.randrange(10 ** (octets * 2)), octets) )
+    elif field.type == "rev_bcd":
+        return bytes( reversed(bcd_encode(rng.randrange(10 ** (octets * 2)), octets)) )
+    elif field.type == "bcdt":
+        squelch_type_id = rng.randrange(4)
+        if squelch_type_id == 3:
+            return bytes([field.zero_value]) * octets
+        encoded = bcd_encode(rng.randrange(670, 2542) if squelch_type_id == 0 else rng.randrange(778), octets)
+        encoded[1] |= squelch_type_id << 6
+        return bytes(encoded)
+    else:   # int/binary wider than an octet
+        return rng.choice([bytes(octets), b'\xff' * octets, rng.randbytes(octets)])
+
+def roundtrip_table(table, num_records, rng):
+    """Check decode(encode(x)) == x and byte-exact load/dump for random records
+
+    Uses num_records records of table's layout at offset 0. If the table has
+    a deletion marker, about one in eight records is a deleted slot: either
+    blank_record() or random octets with the marker set. The others get a
+    random value for every field over random octets, so undocumented bits
+    are covered too, and must read back as live.
+    Returns (mismatches, {direction: records per second}).
+    """
+    table.num_records = num_records
+    table.first_record_offset = 0
+    field_ids = table.field_ids()
+    expected = []
+    bases = []
+    for i in range(num_records):
+        if table.deletion_marker_offset is not None and rng.randrange(8) == 0:
+            base = table.blank_record() if rng.randrange(2) else bytearray( rng.randbytes(table.record_length) )
+            base[table.deletion_marker_offset] = table.deletion_marker_value
+            expected.append(None)
+            bases.append(base)
+            continue
+        while True:
+            values = {k: random_field_value(table.fields[k], rng) for k in field_ids}
+            base = rng.randbytes(table.record_length)
+            # Values that happen to write the deletion marker make a deleted record
+            if not table._record_is_deleted( table.encode_values(values, base) ):
+                break
+        expected.append(values)
+        bases.append(base)
+
+    image = bytearray(num_records * table.record_length)
+    t0 = time.perf_counter()
+    for i, values in enumerate(expected):
+        image[i * table.record_length:(i+1) * table.record_length] = \
+            bases[i] if values is None else table.encode_values(values, bases[i])
+    encode_time = time.perf_counter() - t0
+
+    # Rows build their Fields on first use, so that is timed as part of decoding
+    t0 = time.perf_counter()
+    table.load(image)
+    for row in table.rows:
+        len(row)
+    decode_time = time.perf_counter() - t0
+
+    mismatches = []
+    for i, (values, row) in enumerate( zip(expected, table.rows) ):
+        if row['deleted'] != (values is None):
+            mismatches.append( (i, 'deleted', values is None, row['deleted']) )
+        if values is None:
+            continue
+        for k, value in values.items():
+            if row[k].value != value:
+                mismatches.append( (i, k, value, row[k].value) )
+
+    # Dumping over a copy must reproduce the image exactly; dumping over its
+    # inverse must restore every documented bit and leave the others alone
+    dumped = bytearray(image)
+    t0 = time.perf_counter()
+    table.dump(dumped)
+    dump_time = time.perf_counter() - t0
+    covered = bytearray(table.record_length)
+    for k in field_ids:
+        field = table.fields[k]
+        offset, mask, bits = field.encode(0 if field.bits <= 8 else bytes(field.bits // 8))
+        patch_bytes(covered, offset, mask, mask)
+    inverse = bytearray(b ^ 0xFF for b in image)
+    table.dump(inverse)
+    for i in range(num_records):
+        start, end = i * table.record_length, (i+1) * table.record_length
+        restored = bytes( (b & c) | (~b & ~c & 0xFF) for b, c in zip(image[start:end], covered) )
+        if dumped[start:end] != image[start:end] or inverse[start:end] != restored:
+            mismatches.append( (i, 'image', bytes(image[start:end]).hex(), bytes(inverse[start:end]).hex()) )
+
+    rates = {direction: num_records / max(seconds, 1e-9) for direction, seconds in
+             (("encode", encode_time), ("decode", decode_time), ("dump", dump_time))}
+    return mismatches, rates
+
+def pickle_roundtrip(rdtfile):
+    """Check that rdtfile survives pickling, as when load_many() returns it
+    from a process pool
+
+    Returns a list of (table name, record index, expected, got).
+    """
+    copied = pickle.loads( pickle.dumps(rdtfile) )
+    mismatches = []
+    for table_name in rdtfile.table_names:
+        table, copied_table = getattr(rdtfile, table_name), getattr(copied, table_name)
+        if type(copied_table) is not type(table):
+            mismatches.append( (table_name, None, type(table).__name__, type(copied_table).__name__) )
+            continue
+        for i, (row, copied_row) in enumerate( zip(table.rows, copied_table.rows) ):
+            values = [row['deleted']] + [row[k].value for k in row]
+            copied_values = [copied_row['deleted']] + [copied_row[k].value for k in copied_row]
+            if values != copied_values:
+                mismatches.append( (table_name, i, values, copied_values) )
+    return mismatches
+
+def benchmark_roundtrip(num_records, seed, table_names=None):
+    """Run roundtrip_table on every table of the default model, and
+    pickle_roundtrip on an RDTFile of random octets, and report
+
+    Returns the total number of mismatches (0 means bit exact).
+    """
+    rng = random.Random(seed)
+    print("{:14s} {:>8s} {:>12s} {:>12s} {:>12s} {:>10s}".format(
+        "table", "records", "encode/s", "decode/s", "dump/s", "mismatches"))
+    total = 0
+    for table_name, table_class in table_classes.items():
+        if table_names and table_name not in table_names:
+            continue
+        mismatches, rates = roundtrip_table(table_class(), num_records, rng)
+        print("{:14s} {:8d} {:12.0f} {:12.0f} {:12.0f} {:10d}".format(
+            table_name, num_records, rates["encode"], rates["decode"], rates["dump"], len(mismatches)))
+        for i, k, expected, got in mismatches[:5]:
+            print("    record {} {}: expected {!r}, got {!r}".format(i + 1, k, expected, got))
+        total += len(mismatches)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, "random.rdt")
+        with open(fn, "wb") as fo:
+            fo.write( rng.randbytes( int(models()[default_model]['file_size']) ) )
+        rdtfile = RDTFile(fn, quiet=True)
+    for table_name in rdtfile.table_names:
+        for row in getattr(rdtfile, table_name).rows[::2]:
+            len(row)    # build the Fields of half the Rows, so both kinds get pickled
+    mismatches = pickle_roundtrip(rdtfile)
+    print("{:14s} {:8d} {:>12s} {:>12s} {:>12s} {:10d}".format("RDTFile pickle",
+        sum(len(getattr(rdtfile, t).rows) for t in rdtfile.table_names), "", "", "", len(mismatches)))
+    for table_name, i, expected, got in mismatches[:5]:
+        print("    {} record {}: expected {!r}, got {!r}".format(table_name, i, expected, got))
+    total += len(mismatches)
+    print("\n{} (seed {})".format("Bit exact" if total == 0 else "{} MISMATCHES".format(total), seed))
+    return total
+
+def benchmark_decode(sizes, jobs, repeat=3):
+    """Time serial vs process-pool decoding of synthetic Channel+Contact tables
+
+    Each size n is a synthetic image holding n channels and n contacts of
+    random bytes. Prints one line per size and the smallest size at which
+    the pool (already warm, so process start-up is not counted) is faster.
+    Both timings include building every Row's Fields, which always happens
+    in this process. The pooled column is the share of the serial time spent
+    decoding columns and digesting records, the part the workers take over,
+    which bounds the speedup whatever the number of cores.
+    """
+    print("{:>8s} {:>12s} {:>12s} {:>8s} {:>8s}".format("records", "serial ms", "parallel ms", "speedup", "pooled"))
+    crossover = None
+    with decode_pool(jobs) as executor:
+        # Warm up the pool so worker start-up is not billed to the first size
+        list( executor.map(abs, range(jobs)) )
+        for n in sizes:
+            tables = [table_classes['channels'](), table_classes['contacts']()]
+            offset = 0
+            for table in tables:
+                table.num_records = n
+                table.first_record_offset = offset
+                offset += n * table.record_length
+            data = bytes( random.getrandbits(8) for _ in range(offset) )
+            shard_records = max(250, -(-n // jobs))
+
+            serial = parallel = pooled = float('inf')
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                for table in tables:
+                    table.decode_columns(data, 0, n)
+                    table._record_digests(data)
+                pooled = min(pooled, time.perf_counter() - t0)
+
+                t0 = time.perf_counter()
+                for table in tables:
+                    table.load(data)
+                    for row in table.rows:
+                        len(row)
+                serial = min(serial, time.perf_counter() - t0)
+
+                t0 = time.perf_counter()
+                load_tables_parallel(tables, data, executor, shard_records)
+                for table in tables:
+                    for row in table.rows:
+                        len(row)
+                parallel = min(parallel, time.perf_counter() - t0)
+
+            print("{:8d} {:12.1f} {:12.1f} {:8.2f} {:7.0f}%".format(n, serial * 1000, parallel * 1000,
+                                                               serial / parallel, 100 * min(1, pooled / serial)))
+            if crossover is None and parallel < serial:
+                crossover = n
+    if crossover is None:
+        print("\nParallel decoding did not pay off at any size tested with {} workers".format(jobs))
+    else:
+        print("\nParallel decoding pays off from ~{} records per table with {} workers".format(crossover, jobs))
 
-        print("Loading {}...".format(fn), end='', flush=True)
-        self.settings.load(file_contents)
-        self.channels.load(file_contents)
-        self.contacts.load(file_contents)
-        self.rxgroups.load(file_contents)
-        self.scanlists.load(file_contents)
-        self.textmessages.load(file_contents)
-        self.zones.load(file_contents)
+def write_ndjson_record(out, table_name, i, row, rendered=False):
+    """Write one record as a line of JSON to out, a binary stream
 
-        print("ok\n")
+    values holds Field.typed_value() for each field; with rendered, a
+    rendered object holds the same strings the text output shows.
+    """
+    record = {"table": table_name, "record": i + 1, "deleted": row['deleted'],
+              "values": {k: row[k].typed_value() for k in row}}
+    if rendered:
+        record["rendered"] = {k: str(row[k]) for k in row}
+    out.write( json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n' )
+
+def output_ndjson(args, out):
+    """list, details and settings get in --format ndjson
+
+    Only the requested table is decoded, and each record is written as
+    soon as it is decoded.
+    """
+    file_contents = _read_file(args.file)
+    table_name = "settings" if args.subparser_name == "settings" else args.table
+    table = load_model( detect_model(file_contents) )[table_name]()
+    if args.subparser_name == "list":
+        for i, row in table.iter_rows(file_contents):
+            if not row['deleted']:
+                write_ndjson_record(out, table_name, i, row, args.rendered)
+    elif args.subparser_name == "details":
+        row_num = int(args.row)
+        if not 0 <= row_num < table.num_records:
+            print("{} row {} out of range (0..{})".format(table_name, row_num, table.num_records - 1), file=sys.stderr)
+            return 1
+        write_ndjson_record(out, table_name, row_num, table._load_record(file_contents, row_num), args.rendered)
+    else:
+        row = table._load_record(file_contents, 0)
+        if args.field != "all":
+            if args.field not in row:
+                print("{} is not a valid field key name.".format(args.field), file=sys.stderr)
+                return 1
+            for k in [k for k in row if k != args.field]:
+                del row[k]
+        write_ndjson_record(out, table_name, 0, row, args.rendered)
+    out.flush()
+    return 0
 
 def prettyprint_record(record):
     #TODO need to specify field order somehow
@@ -849,16 +2244,21 @@ def prettyprint_table(rows, field_names = ['name']):
             # if not row['deleted']:
             print( format_string.format(i+1, *field_values) )   # ids are 1-indexed :-/
 
-def main():
-    print("\npyRDT by AE5ST\n")
+def print_banner(file=sys.stdout):
+    print("\npyRDT by AE5ST\n", file=file)
     url1 = "http://www.iz2uuf.net/wp/index.php/2016/06/04/tytera-dm380-codeplug-binary-format/"
     url2 = "https://github.com/travisgoodspeed/md380tools/blob/master/chirp/md380.py"
-    print("*** Special thanks to IZ2UUF and Travis Goodspeed (KK4VCZ) for documenting the RDT file format:")
-    print("    {}".format(url1))
-    print("    {}\n".format(url2))
+    print("*** Special thanks to IZ2UUF and Travis Goodspeed (KK4VCZ) for documenting the RDT file format:", file=file)
+    print("    {}".format(url1), file=file)
+    print("    {}\n".format(url2), file=file)
 
+def main():
     parser = argparse.ArgumentParser(description = "Read and write RDT codeplug files")
     parser.add_argument("-f", "--file", help="RDT codeplug file")
+    parser.add_argument("--format", choices=['text', 'ndjson'], default='text',
+                        help="list/details/settings get: human readable text, or one JSON object per record")
+    parser.add_argument("--rendered", action="store_true", help="ndjson: also include the rendered text of each value")
+    parser.add_argument("-j", "--jobs", type=int, help="Decode tables in this many worker processes")
     subparsers = parser.add_subparsers(title="Subcommand", dest="subparser_name", help="Subcommand help")
 
     settings_cmd = subparsers.add_parser("settings", help="General radio settings")
@@ -877,12 +2277,145 @@ def main():
 
     import_cmd = subparsers.add_parser("import", help="Import a table from a CSV to the RDT codeplug file")
     import_cmd.add_argument("table", choices=['channels', 'contacts', 'rxgroups', 'scanlists', 'textmessages', 'zones'], help="Which table?")
+    import_cmd.add_argument("--from-userdb", metavar="CSV", help="contacts: pick contacts from a DMR user database CSV")
+    import_cmd.add_argument("--limit", type=int, help="--from-userdb: at most this many contacts (default: all records)")
+    import_cmd.add_argument("--region", default="", help="--from-userdb: only these states/countries (comma separated)")
+    import_cmd.add_argument("--prefix", default="", help="--from-userdb: prefer callsigns with these prefixes (comma separated)")
+    import_cmd.add_argument("--priority", metavar="FILE", help="--from-userdb: ids or callsigns to rank first, one per line")
+    import_cmd.add_argument("--replace", action="store_true",
+                            help="--from-userdb: replace all contacts instead of filling free slots (channels and RX groups keep their slot numbers)")
+    import_cmd.add_argument("-o", "--output", help="Write the result here instead of back to the RDT file")
+
+    watch_cmd = subparsers.add_parser("watch", help="Watch the RDT codeplug file and report records as they change")
+    watch_cmd.add_argument("-i", "--interval", type=float, default=1.0, help="Polling interval in seconds (default: 1)")
+
+    analyze_cmd = subparsers.add_parser("analyze", help="Find duplicates and conflicts in one or many RDT files")
+    analyze_cmd.add_argument("table", choices=['channels'], help="Which table?")
+    analyze_cmd.add_argument("files", nargs='*', help="RDT files (default: -f)")
+    analyze_cmd.add_argument("--tolerance", type=float, default=0, help="rx frequencies this many kHz apart count as the same")
+    analyze_cmd.add_argument("--top", type=int, default=10, help="Fleet summary: show this many of the most widespread channels")
+
+    apply_cmd = subparsers.add_parser("apply", help="Apply a file of table:row:field=value edits to many RDT files")
+    apply_cmd.add_argument("patchfile", help="One edit per line, e.g. channels:*:power=high or settings:radio_name=Base 7")
+    apply_cmd.add_argument("files", nargs='+', help="RDT files to edit in place")
+
+    merge_cmd = subparsers.add_parser("merge", help="Merge channels, contacts, zones, scan lists and RX groups of several RDT files")
+    merge_cmd.add_argument("output", help="Merged RDT file to write")
+    merge_cmd.add_argument("files", nargs='+', help="RDT files to merge; settings and text messages come from the first")
+
+    grep_cmd = subparsers.add_parser("grep", help="Search names and text messages of many RDT files")
+    grep_cmd.add_argument("pattern", help="Text to look for")
+    grep_cmd.add_argument("files", nargs='+', help="RDT files to search")
+    grep_cmd.add_argument("-i", "--ignore-case", action="store_true", help="Case insensitive")
+    grep_cmd.add_argument("-E", "--regex", action="store_true", help="pattern is a regular expression")
+    grep_cmd.add_argument("-t", "--table", action="append", choices=['settings', 'channels', 'contacts', 'rxgroups', 'scanlists', 'textmessages', 'zones'],
+                          help="Only search this table (may be repeated)")
+    grep_cmd.add_argument("-l", "--files-with-matches", action="store_true", help="Only print the names of matching files")
+
+    bench_cmd = subparsers.add_parser("bench", help="Benchmarks (no RDT file needed)")
+    bench_cmd.add_argument("benchmark", choices=['decode', 'roundtrip'],
+                           help="decode: serial vs parallel table decoding; roundtrip: encode/decode/dump exactness and throughput, and RDTFile pickling")
+    bench_cmd.add_argument("--sizes", default="250,1000,3000,10000,30000", help="Comma separated records per table")
+    bench_cmd.add_argument("--repeat", type=int, default=3, help="Best of this many runs")
+    bench_cmd.add_argument("--records", type=int, default=1000, help="roundtrip: random records per table")
+    bench_cmd.add_argument("--seed", type=int, help="roundtrip: random seed (default: random)")
+    bench_cmd.add_argument("-t", "--table", action="append", choices=list(table_classes), help="roundtrip: only this table (may be repeated)")
     
     args = parser.parse_args()
 
+    # Keep stdout clean for machine-readable output
+    print_banner(sys.stderr if args.format == "ndjson" else sys.stdout)
+    if args.format == "ndjson" and (args.subparser_name in ("list", "details") or
+                                    (args.subparser_name == "settings" and args.subcommand == "get")):
+        return output_ndjson(args, sys.stdout.buffer)
+
+    if args.subparser_name == "analyze":
+        if not args.files and not args.file:
+            analyze_cmd.error("no RDT files given (pass them as arguments or with -f)")
+        # Frequencies are in units of 10 Hz
+        analyze_channels_fleet(args.files or [args.file], round(args.tolerance * 100), args.top)
+        return 0
+
+    if args.subparser_name == "apply":
+        try:
+            with open(args.patchfile, 'r') as fi:
+                edits = fi.readlines()
+            compile_edits(edits)    # report mistakes before touching any file
+        except (OSError, ValueError) as e:
+            print("{}: {}".format(args.patchfile, e))
+            return 1
+        failures = 0
+        if args.jobs:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+                reports = executor.map(_apply_patches_report, args.files, itertools.repeat(edits), chunksize=16)
+                for report, ok in reports:
+                    print(report)
+                    failures += not ok
+        else:
+            for fn in args.files:
+                report, ok = _apply_patches_report(fn, edits)
+                print(report)
+                failures += not ok
+        return 1 if failures else 0
+
+    if args.subparser_name == "merge":
+        try:
+            merged, report = merge_images([_read_file(fn) for fn in args.files])
+        except (OSError, ValueError) as e:
+            print(e)
+            return 1
+        atomic_write(args.output, merged)
+        overflow = False
+        for name in merge_order:
+            unique, dropped, slots = report[name]
+            print("{:10s} {:5d} unique records, {:5d} slots".format(name, unique, slots), end='')
+            if dropped:
+                overflow = True
+                print(", OVERFLOW: {} records dropped".format(dropped), end='')
+            print()
+        print("Wrote {}".format(args.output))
+        return 1 if overflow else 0
+
+    if args.subparser_name == "grep":
+        pattern = compile_utf16_search(args.pattern, args.ignore_case, args.regex)
+        found = False
+        if args.jobs:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs)
+            results = executor.map(grep_file, args.files, itertools.repeat(pattern),
+                                   itertools.repeat(args.table), chunksize=32)
+        else:
+            executor = None
+            results = (grep_file(fn, pattern, args.table) for fn in args.files)
+        for fn, hits in results:
+            if isinstance(hits, Exception):
+                print("{}: ERROR {}".format(fn, hits), file=sys.stderr)
+                continue
+            if hits:
+                found = True
+                if args.files_with_matches:
+                    print(fn)
+                    continue
+            for table_name, i, field_id, text in hits:
+                print("{}:{}:{}:{}: {}".format(fn, table_name, i + 1, field_id, text))
+        if executor:
+            executor.shutdown()
+        return 0 if found else 1
+
+    if args.subparser_name == "bench":
+        if args.benchmark == "roundtrip":
+            seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+            return 1 if benchmark_roundtrip(args.records, seed, args.table) else 0
+        sizes = [int(n) for n in args.sizes.split(',')]
+        benchmark_decode(sizes, args.jobs or os.cpu_count(), args.repeat)
+        return 0
+
     # TODO: detect None subcommand before rdt file parsing and print help
     # TODO: validate file exists
-    rdtfile = RDTFile(args.file)
+    if args.jobs:
+        with decode_pool(args.jobs) as executor:
+            rdtfile = RDTFile(args.file, executor)
+    else:
+        rdtfile = RDTFile(args.file)
 
     if args.subparser_name == "settings":
         if args.subcommand == "get":
@@ -897,7 +2430,15 @@ def main():
             else:
                 print("TODO: print usage -- get <fieldname|all> (should have been caught by parser though)")
         elif args.subcommand == "set":
-            print("TODO: Set a field and write back file")
+            if '=' not in args.field:
+                print("set: expected <field=value>")
+                return 1
+            try:
+                apply_patches(args.file, ["settings:" + args.field])
+            except ValueError as e:
+                print(e)
+                return 1
+            print("{} written".format(args.file))
         else:
             raise ValueError("subcommand neither get nor set -- should have been caught by arg parser")
     
@@ -920,6 +2461,49 @@ def main():
     elif args.subparser_name == "details":
         row_num = int(args.row)
         prettyprint_record( rdtfile.__getattribute__(args.table).rows[row_num] )
+
+    elif args.subparser_name == "import" and args.table == "contacts" and args.from_userdb:
+        priority = []
+        if args.priority:
+            with open(args.priority, 'r') as fi:
+                priority = [line.strip() for line in fi if line.strip()]
+        contacts = rdtfile.contacts
+        old_ids = [None if row['deleted'] else int.from_bytes(row._raw_value('call_id'), "little")
+                   for row in contacts.rows]
+        if args.replace:
+            existing, free = set(), contacts.num_records
+        else:
+            existing, free = set(old_ids), old_ids.count(None)
+            if not free:
+                print("No free contact slots in {} (--replace replaces all contacts)".format(args.file), file=sys.stderr)
+                return 1
+        limit = min(args.limit or free, free)
+        chosen = select_contacts( (entry for entry in read_userdb(args.from_userdb) if entry.call_id not in existing), limit,
+            regions  = [r.strip() for r in args.region.split(',') if r.strip()],
+            prefixes = [p.strip() for p in args.prefix.split(',') if p.strip()],
+            priority = priority )
+        data = bytearray(rdtfile.file_contents)
+        encode_userdb_contacts(contacts, chosen, data, args.replace)
+        if args.replace:
+            # Channels and RX groups refer to contacts by slot number
+            references = contact_references( {t: getattr(rdtfile, t) for t in ('channels', 'rxgroups')},
+                                             contacts.num_records )
+            for slot, referrers in sorted( references.items() ):
+                new_id = chosen[slot].call_id if slot < len(chosen) else None
+                if old_ids[slot] is not None and new_id != old_ids[slot]:
+                    print("warning: contact {} was {}, now {}; still referred to by {}".format(
+                        slot + 1, old_ids[slot], new_id if new_id is not None else "empty",
+                        ", ".join("{} {} {}".format(t, i + 1, k) for t, i, k in referrers)), file=sys.stderr)
+        atomic_write(args.output or args.file, data)
+        print("Imported {} contacts into {}".format(len(chosen), args.output or args.file))
+
+    elif args.subparser_name == "watch":
+        print("Watching {} (Ctrl-C to stop)".format(args.file))
+        try:
+            for event in rdtfile.watch(args.interval):
+                print( format_change_event(event), flush=True )
+        except KeyboardInterrupt:
+            pass
     
     else:
         print("Unknown subcommand {}".format(args.subparser_name))
@@ -928,4 +2512,4 @@ def main():
     return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit( main() )
\ No newline at end of file